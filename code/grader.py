@@ -1,16 +1,26 @@
+from __future__ import annotations
+
+import asyncio
 import base64
+import functools
+import hashlib
+import mmap
+from concurrent.futures import ThreadPoolExecutor
 import gradio as gr
-from openai import OpenAI
+import httpx
+import io
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 import os
-import datetime
-import json
-import pandas as pd
+import stat
+import orjson
 from pathlib import Path
-import re
+from PIL import Image, ImageOps
 import logging
+import threading
+import time
 from logging.handlers import RotatingFileHandler
 from dotenv import load_dotenv
-from typing import Generator
+from typing import AsyncGenerator, AsyncIterable
 
 # --- 日志配置 ---
 LOG_FILE = "app.log"
@@ -30,9 +40,13 @@ def log_event(event_type: str, status: str, details: str = ""):
 load_dotenv(override=True)
 TEXTS_DIR = "texts"
 RATES_DIR = "rates"
-HISTORY_PATH = "history.json"
+CACHE_DIR = "cache"
+PROMPT_PATH = "prompt/prompt.txt"
+HISTORY_PATH = "history.jsonl"
+LEGACY_HISTORY_PATH = "history.json"
 os.makedirs(TEXTS_DIR, exist_ok=True)
 os.makedirs(RATES_DIR, exist_ok=True)
+os.makedirs(CACHE_DIR, exist_ok=True)
 
 # --- 配置参数 ---
 class Config:
@@ -42,61 +56,268 @@ class Config:
     RATING_MODEL = os.getenv("RATING_MODEL", "Qwen/Qwen2.5-32B-Instruct") 
     MAX_FILE_SIZE_MB = 5
     ALLOWED_EXTENSIONS = [".jpg", ".jpeg", ".png"]
+    IMAGE_MAX_EDGE = 1600          # 上传前图片最长边（像素）
+    IMAGE_JPEG_QUALITY = 85
+    STREAM_FLUSH_CHARS = 8192      # 流式输出合并的最大字符数
+    STREAM_FLUSH_INTERVAL = 0.025  # 流式输出合并的最长间隔（秒）
+    CACHE_REPLAY_CHARS = 512       # 命中缓存时每段输出的字符数
+    BATCH_CONCURRENCY = 8          # 批量批改时同时处理的作文篇数
+    EVENT_CONCURRENCY = 16         # 批改事件可同时服务的用户数（Gradio默认为1）
+    UI_TEXT_INTERVAL = 0.05        # 提取文本的界面最短刷新间隔（秒）
+    UI_RATE_INTERVAL = 0.08        # 批改结果的界面最短刷新间隔（秒）
 
 config = Config()
 
+# --- API客户端（全局复用连接池） ---
+# 保留SDK默认的超时和重定向设置，只调整连接池大小
+_HTTP_CLIENT = DefaultAsyncHttpxClient(
+    limits=httpx.Limits(max_keepalive_connections=16, max_connections=32)
+)
+_client: AsyncOpenAI | None = None
+
+if not config.API_KEY:
+    log_event("SYSTEM", "未配置 MODELSCOPE_API_KEY", "批改请求将无法调用API")
+
+def get_client() -> AsyncOpenAI:
+    """首次使用时创建API客户端，未配置密钥时不影响应用启动"""
+    global _client
+    if _client is None:
+        if not config.API_KEY:
+            raise ValueError("未配置 MODELSCOPE_API_KEY，请在 .env 文件中设置")
+        _client = AsyncOpenAI(base_url=config.API_BASE_URL, api_key=config.API_KEY, http_client=_HTTP_CLIENT)
+    return _client
+
+_warmed_up = False
+_warmup_lock = asyncio.Lock()
+
+async def warmup_client() -> None:
+    """预先建立到API的连接，避免首个请求承担TLS握手开销（每个进程只执行一次）"""
+    global _warmed_up
+    async with _warmup_lock:
+        if _warmed_up:
+            return
+        _warmed_up = True
+        try:
+            await _HTTP_CLIENT.head(config.API_BASE_URL, timeout=5)
+            log_event("SYSTEM", "API连接预热完成")
+        except httpx.HTTPError as e:
+            log_event("SYSTEM", "API连接预热失败", str(e))
+
 # --- 历史记录功能 ---
+# 每行一条记录（JSONL），新记录直接追加到文件末尾
+# 已解析的历史记录，按 (mtime_ns, size) 判断文件是否变化
+_history_cache: tuple[tuple[int, int], list] | None = None
+_history_lock = threading.Lock()
+# 单线程写入，保证记录顺序，同时不阻塞界面的“批改完成”状态
+_history_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-writer")
+
+def _migrate_legacy_history() -> None:
+    """将旧版 history.json 转换为 JSONL 格式"""
+    if os.path.exists(HISTORY_PATH) or not os.path.exists(LEGACY_HISTORY_PATH):
+        return
+    try:
+        legacy = orjson.loads(Path(LEGACY_HISTORY_PATH).read_bytes())
+    except orjson.JSONDecodeError as e:
+        log_event("SYSTEM", "旧版历史记录迁移失败", str(e))
+        return
+    # 先写临时文件再原子替换，避免进程中断时留下不完整的文件
+    tmp_path = HISTORY_PATH + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(b"".join(orjson.dumps(entry) + b"\n" for entry in legacy))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, HISTORY_PATH)
+    log_event("SYSTEM", "旧版历史记录已迁移", f"{len(legacy)} 条")
+
 def load_history() -> list:
+    # 返回副本，缓存中的列表只在持锁时由 append_history 修改
+    with _history_lock:
+        return list(_load_history_locked())
+
+def _load_history_locked() -> list:
+    global _history_cache
     try:
-        with open(HISTORY_PATH, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError) as e:
+        st = os.stat(HISTORY_PATH)
+    except FileNotFoundError as e:
         log_event("SYSTEM", "历史记录加载失败", str(e))
         return []
-
-def save_history(history: list) -> None:
-    with open(HISTORY_PATH, "w", encoding="utf-8") as f:
-        json.dump(history, f, ensure_ascii=False, indent=2)
+    key = (st.st_mtime_ns, st.st_size)
+    if _history_cache is not None and _history_cache[0] == key:
+        return _history_cache[1]
+    history = []
+    with open(HISTORY_PATH, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                history.append(orjson.loads(line))
+            except orjson.JSONDecodeError as e:
+                log_event("SYSTEM", "历史记录行解析失败", str(e))
+    _history_cache = (key, history)
+    return history
+
+def append_history(entry: dict) -> None:
+    global _history_cache
+    with _history_lock:
+        history = _load_history_locked()
+        line = orjson.dumps(entry) + b"\n"
+        with open(HISTORY_PATH, "ab+") as f:
+            # 上次写入被中断时补齐换行，避免新记录与残缺行粘连
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    line = b"\n" + line
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        # 同步更新内存中的副本，避免下次加载重新读取整个文件
+        history.append(entry)
+        st = os.stat(HISTORY_PATH)
+        _history_cache = ((st.st_mtime_ns, st.st_size), history)
+
+def append_history_async(entry: dict) -> None:
+    """在后台线程中写入历史记录"""
+    def _on_done(future):
+        if future.exception() is not None:
+            log_event("ERROR", "历史记录保存失败", str(future.exception()))
+    _history_writer.submit(append_history, entry).add_done_callback(_on_done)
 
 # --- Helper Functions ---
+_FORBIDDEN_FILENAME_CHARS = str.maketrans("", "", '\\/*?:"<>|')
+
 def sanitize_filename(title: str) -> str:
-    sanitized = re.sub(r'[\\/*?:"<>|]', "", title.strip())
-    return sanitized[:50]
+    return title.strip().translate(_FORBIDDEN_FILENAME_CHARS)[:50]
+
+def _now_compact() -> str:
+    """当前时间，格式同 strftime("%Y%m%d_%H%M%S")"""
+    t = time.localtime()
+    return f"{t.tm_year:04d}{t.tm_mon:02d}{t.tm_mday:02d}_{t.tm_hour:02d}{t.tm_min:02d}{t.tm_sec:02d}"
+
+def _now_display() -> str:
+    """当前时间，格式同 strftime("%Y-%m-%d %H:%M")"""
+    t = time.localtime()
+    return f"{t.tm_year:04d}-{t.tm_mon:02d}-{t.tm_mday:02d} {t.tm_hour:02d}:{t.tm_min:02d}"
 
 def safe_save(content: str, directory: str, filename: str) -> str:
     safe_dir = Path(directory).resolve()
     safe_dir.mkdir(exist_ok=True)
     safe_name = sanitize_filename(filename)
-    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    save_path = safe_dir / f"{safe_name}_{timestamp}.txt"
-    with open(save_path, "w", encoding="utf-8") as f:
-        f.write(content)
-    return str(save_path)
+    timestamp = _now_compact()
+    data = content.encode("utf-8")
+    # 同题作文可能在同一秒内完成（批量模式），用独占创建避免互相覆盖
+    suffix = ""
+    counter = 0
+    while True:
+        save_path = safe_dir / f"{safe_name}_{timestamp}{suffix}.txt"
+        try:
+            with open(save_path, "xb") as f:
+                f.write(data)
+            return str(save_path)
+        except FileExistsError:
+            counter += 1
+            suffix = f"_{counter}"
 
 def validate_image_files(files: list[str]) -> None:
     if not files:
         raise ValueError("未上传任何图片")
+    max_size = config.MAX_FILE_SIZE_MB * 1024 * 1024
     for file_path in files:
-        file = Path(file_path)
-        if not file.exists():
+        # 每个文件只做一次stat系统调用
+        try:
+            st = os.stat(file_path)
+        except FileNotFoundError:
             raise ValueError(f"文件不存在: {file_path}")
-        if file.suffix.lower() not in config.ALLOWED_EXTENSIONS:
-            raise ValueError(f"不支持的文件类型: {file.suffix}")
-        if file.stat().st_size > config.MAX_FILE_SIZE_MB * 1024 * 1024:
-            raise ValueError(f"文件过大: {file.name} ({file.stat().st_size//1024//1024}MB)")
-
-def encode_image_to_base64(image_path: str) -> str:
+        if not stat.S_ISREG(st.st_mode):
+            raise ValueError(f"文件不存在: {file_path}")
+        suffix = os.path.splitext(file_path)[1]
+        if suffix.lower() not in config.ALLOWED_EXTENSIONS:
+            raise ValueError(f"不支持的文件类型: {suffix}")
+        if st.st_size > max_size:
+            raise ValueError(f"文件过大: {os.path.basename(file_path)} ({st.st_size//1024//1024}MB)")
+
+def encode_image_to_base64(image_path: str) -> bytes:
+    """返回base64字节串；通过mmap直接编码，省去一次整图read()拷贝"""
     try:
         with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode("utf-8")
+            if os.fstat(image_file.fileno()).st_size == 0:
+                return b""
+            with mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return base64.b64encode(mm)
     except Exception as e:
         log_event("ERROR", "图片编码失败", str(e))
         raise
 
+def prepare_image(image_path: str) -> bytes:
+    """缩小并压缩为JPEG，返回base64字节串"""
+    try:
+        with Image.open(image_path) as img:
+            # 尺寸已达标的JPEG直接上传原文件，无需重新编码
+            if img.format == "JPEG" and max(img.size) <= config.IMAGE_MAX_EDGE:
+                return encode_image_to_base64(image_path)
+            # JPEG按DCT缩放解码，减少大图的解码开销
+            img.draft("RGB", (config.IMAGE_MAX_EDGE, config.IMAGE_MAX_EDGE))
+            img = ImageOps.exif_transpose(img)  # 重新编码会丢失EXIF，先校正手机照片方向
+            if img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info):
+                # 透明背景铺白色，直接转RGB会让透明区域变黑、遮住笔迹
+                img = img.convert("RGBA")
+                background = Image.new("RGB", img.size, "white")
+                background.paste(img, mask=img.getchannel("A"))
+                img = background
+            elif img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            img.thumbnail((config.IMAGE_MAX_EDGE, config.IMAGE_MAX_EDGE), Image.Resampling.LANCZOS)
+            buffer = io.BytesIO()
+            img.save(buffer, format="JPEG", quality=config.IMAGE_JPEG_QUALITY, optimize=True)
+        return base64.b64encode(buffer.getbuffer())
+    except Exception as e:
+        log_event("ERROR", "图片压缩失败", str(e))
+        raise
+
+async def iter_deltas(response) -> AsyncGenerator[str, None]:
+    """从流式响应中取出非空的增量文本"""
+    async for chunk in response:
+        delta = chunk.choices[0].delta.content
+        if delta:
+            yield delta
+
+async def coalesce_stream(deltas: AsyncIterable[str]) -> AsyncGenerator[str, None]:
+    """按时间/大小合并增量文本，减少界面刷新次数"""
+    pending: list[str] = []
+    append = pending.append
+    pending_size = 0
+    last_flush = 0.0  # 首个增量立即输出，保证首字延迟
+    async for delta in deltas:
+        append(delta)
+        pending_size += len(delta)
+        now = time.monotonic()
+        if pending_size >= config.STREAM_FLUSH_CHARS or now - last_flush >= config.STREAM_FLUSH_INTERVAL:
+            yield "".join(pending)
+            pending.clear()
+            pending_size = 0
+            last_flush = now
+    if pending:
+        yield "".join(pending)
+
+@functools.lru_cache(maxsize=4)
+def _load_prompt(path: str, mtime_ns: int, size: int) -> str:
+    """读取评分模板，按修改时间和大小缓存"""
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+def load_prompt_template(prompt_path: Path) -> str:
+    try:
+        st = os.stat(prompt_path)
+    except FileNotFoundError:
+        raise FileNotFoundError("评分模板文件不存在")
+    return _load_prompt(str(prompt_path), st.st_mtime_ns, st.st_size)
+
 # --- 核心处理逻辑 ---
-def stream_extract_text(image_paths: list[str]) -> Generator[str, None, str]:
-    client = OpenAI(base_url=config.API_BASE_URL, api_key=config.API_KEY)
-    
+def encode_images(image_paths: list[str]) -> list[bytes]:
+    """并行压缩并编码多张图片，结果保持上传顺序"""
+    with ThreadPoolExecutor(max_workers=min(8, len(image_paths))) as executor:
+        return list(executor.map(prepare_image, image_paths))
+
+async def stream_extract_text(image_paths: list[str]) -> AsyncGenerator[str, None]:
     messages = [{
         "type": "text",
         "text": "忽略红色的批改文本和其他乱涂乱画的笔迹，提取出图片中作文的文本内容，包括作文题目和作文正文。"
@@ -104,39 +325,30 @@ def stream_extract_text(image_paths: list[str]) -> Generator[str, None, str]:
                 "对于文中的错别字，你无需修正，同时，输出文本的段落结构需要与作文中的段落结构保持一致"
     }]
 
-    for path in image_paths:
-        base64_image = encode_image_to_base64(path)
+    base64_images = await asyncio.to_thread(encode_images, image_paths)
+
+    # prepare_image 统一输出JPEG
+    for base64_image in base64_images:
         messages.append({
             "type": "image_url",
-            "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}
+            "image_url": {"url": (b"data:image/jpeg;base64," + base64_image).decode("ascii")}
         })
 
-    response = client.chat.completions.create(
+    response = await get_client().chat.completions.create(
         model=config.EXTRACTION_MODEL,
         messages=[{"role": "user", "content": messages}],
         stream=True
     )
 
-    full_text = ""
-    for chunk in response:
-        if chunk.choices[0].delta.content:
-            chunk_text = chunk.choices[0].delta.content
-            full_text += chunk_text
-            yield full_text
-    return full_text
-
-def stream_rate_text(content: str) -> Generator[str, None, str]:
-    client = OpenAI(base_url=config.API_BASE_URL, api_key=config.API_KEY)
-    
+    # 只产出增量文本，由调用方统一拼接，避免字符串重复拷贝
+    async for chunk_text in coalesce_stream(iter_deltas(response)):
+        yield chunk_text
+
+async def stream_rate_text(content: str) -> AsyncGenerator[str, None]:
     try:
-        prompt_path = Path("prompt/prompt.txt")
-        if not prompt_path.exists():
-            raise FileNotFoundError("评分模板文件不存在")
-        
-        with open(prompt_path, "r", encoding="utf-8") as f:
-            prompt_template = f.read()
-
-        response = client.chat.completions.create(
+        prompt_template = load_prompt_template(Path(PROMPT_PATH))
+
+        response = await get_client().chat.completions.create(
             model=config.RATING_MODEL,
             messages=[
                 {"role": "system", "content": "你是一位专业的语文老师，需要根据评分标准对作文进行详细批改"},
@@ -146,68 +358,134 @@ def stream_rate_text(content: str) -> Generator[str, None, str]:
             temperature=1
         )
 
-        full_response = ""
-        for chunk in response:
-            if chunk.choices[0].delta.content:
-                chunk_text = chunk.choices[0].delta.content
-                full_response += chunk_text
-                yield full_response
-        return full_response
+        async for chunk_text in coalesce_stream(iter_deltas(response)):
+            yield chunk_text
 
     except Exception as e:
         log_event("ERROR", "评分失败", str(e))
         raise
 
-# --- Gradio界面 ---
-def create_interface():
-    with gr.Blocks(
-        theme=gr.themes.Soft(), 
-        title="作文智能批改系统",
-        css="""
-        .drag-area {
-            border: 2px dashed #666;
-            border-radius: 10px;
-            padding: 20px;
-            transition: all 0.3s;
-            min-height: 500px;
-            position: relative;
-        }
-        .result-area {
-            overflow: none;
-            border: 2px dashed #666;
-            border-radius: 10px;
-            padding: 20px 20px 0 20px;
-        }
-        .drag-area.dragover {
-            border-color: #2196F3;
-            background: #f5fbff;
-        }
-        #upload-btn {
-        }
-        .fixed-height {
-            height: 750px;
-            overflow: auto;
-            box-sizing: border-box;
-            border: 3px solid #e0e0e0;
-            padding: 10px 10px 0 10px;
-            border-radius: 15px;
-            font-size: 25px;
-        }
-        .fixed-height::-webkit-scrollbar {
-            width: 2px;
-        }
-        .fixed-height::-webkit-scrollbar-thumb {
-            background: #888;
-            border-radius: 4px;
-        }
-        """
-    ) as demo:
-        history_state = gr.State(value=load_history())
-        uploaded_files = gr.State([])
+# --- 批改结果缓存 ---
+def essay_cache_key(image_paths: list[str]) -> str:
+    """按图片内容、模型和评分模板计算缓存键"""
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (config.EXTRACTION_MODEL, config.RATING_MODEL, load_prompt_template(Path(PROMPT_PATH))):
+        digest.update(part.encode("utf-8") + b"\0")
+    for path in image_paths:
+        with open(path, "rb") as f:
+            digest.update(str(os.fstat(f.fileno()).st_size).encode("ascii") + b"\0")
+            while chunk := f.read(1024 * 1024):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def load_cached_result(key: str) -> tuple[str, str] | None:
+    """返回缓存的 (提取文本, 批改结果)，未命中时返回None"""
+    try:
+        cached = orjson.loads(Path(CACHE_DIR, f"{key}.json").read_bytes())
+        return cached["text"], cached["rate"]
+    except FileNotFoundError:
+        return None
+    except (orjson.JSONDecodeError, KeyError) as e:
+        log_event("SYSTEM", "缓存读取失败", str(e))
+        return None
+
+def store_cached_result(key: str, full_text: str, full_rate: str) -> None:
+    """写入缓存；失败只记录日志，不影响本次批改结果的保存"""
+    # 空结果多为流被截断或过滤，不缓存，保证可以重新批改
+    if not full_text.strip() or not full_rate.strip():
+        log_event("SYSTEM", "结果为空，跳过缓存", key)
+        return
+    cache_path = Path(CACHE_DIR, f"{key}.json")
+    tmp_path = cache_path.with_suffix(".tmp")
+    try:
+        tmp_path.write_bytes(orjson.dumps({"text": full_text, "rate": full_rate}))
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        log_event("ERROR", "缓存写入失败", str(e))
+
+def _lookup_cached_sync(image_paths: list[str]) -> tuple[str, tuple[str, str] | None]:
+    key = essay_cache_key(image_paths)
+    return key, load_cached_result(key)
+
+async def lookup_cached(image_paths: list[str]) -> tuple[str, tuple[str, str] | None]:
+    """在线程中计算缓存键并读取缓存，返回 (缓存键, 缓存结果或None)"""
+    key, cached = await asyncio.to_thread(_lookup_cached_sync, image_paths)
+    if cached is not None:
+        log_event("SYSTEM", "命中批改缓存", key)
+    return key, cached
+
+async def replay_text(text: str) -> AsyncGenerator[str, None]:
+    """分段输出缓存内容，不额外等待，界面刷新频率由显示循环控制"""
+    for start in range(0, len(text), config.CACHE_REPLAY_CHARS):
+        yield text[start:start + config.CACHE_REPLAY_CHARS]
+
+def split_essay(full_text: str) -> tuple[str, str]:
+    """将提取结果拆分为题目和正文"""
+    lines = full_text.split("\n", 1)
+    title = lines[0].strip() or "未命名作文"
+    content = lines[1].strip() if len(lines) > 1 else ""
+    return title, content
+
+async def save_results(title: str, content: str, full_rate: str) -> dict:
+    """在线程中并发保存文本和批改结果，并写入历史记录"""
+    text_path, rate_path = await asyncio.gather(
+        asyncio.to_thread(safe_save, content, TEXTS_DIR, title),
+        asyncio.to_thread(safe_save, full_rate, RATES_DIR, f"{title}_批改")
+    )
+    new_entry = {
+        "title": title,
+        "timestamp": _now_display(),
+        "text_path": text_path,
+        "rate_path": rate_path
+    }
+    append_history_async(new_entry)
+    return new_entry
+
+async def finish_essay(cache_key: str, cached: tuple[str, str] | None, full_text: str, full_rate: str) -> dict:
+    """拆分题目、未命中时写入缓存，并保存结果和历史记录"""
+    title, content = split_essay(full_text)
+    if cached is None:
+        await asyncio.to_thread(store_cached_result, cache_key, full_text, full_rate)
+    return await save_results(title, content, full_rate)
+
+def history_rows(history: list) -> list[list[str]]:
+    """将历史记录转换为表格行，直接交给Dataframe组件，省去pandas构建和类型推断"""
+    return [[e["title"], e["timestamp"], e["text_path"], e["rate_path"]] for e in history]
+
+async def grade_essay(image_paths: list[str]) -> dict:
+    """非流式地完成一篇作文的提取和批改"""
+    validate_image_files(image_paths)
+    cache_key, cached = await lookup_cached(image_paths)
+    if cached is not None:
+        full_text, full_rate = cached
+    else:
+        full_text = "".join([part async for part in stream_extract_text(image_paths)])
+        _, content = split_essay(full_text)
+        full_rate = "".join([part async for part in stream_rate_text(content)])
+    return await finish_essay(cache_key, cached, full_text, full_rate)
+
+async def grade_batch(essays: list[list[str]]) -> AsyncGenerator[tuple[int, dict | None, Exception | None], None]:
+    """并发批改多篇作文，按完成顺序产出 (序号, 历史记录, 异常)"""
+    semaphore = asyncio.Semaphore(config.BATCH_CONCURRENCY)
+
+    async def run(index: int, image_paths: list[str]):
+        async with semaphore:
+            try:
+                return index, await grade_essay(image_paths), None
+            except Exception as e:
+                log_event("ERROR", "批量批改失败", f"第{index + 1}篇: {e}")
+                return index, None, e
+
+    tasks = [asyncio.create_task(run(i, paths)) for i, paths in enumerate(essays)]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            yield await finished
+    finally:
+        # 客户端断开或事件被取消时，停止尚未完成的批改
+        for task in tasks:
+            if not task.done():
+                task.cancel()
 
-        # 界面布局
-        gr.Markdown("<center><h1>📚 智能作文批改系统</h1></center>")
-        gr.Markdown("<center><h3>上传作文图片，自动提取文字并生成批改建议</h3></center>")
 # --- Gradio界面 ---
 def create_interface():
     with gr.Blocks(
@@ -278,6 +556,13 @@ def create_interface():
                         start_btn = gr.Button("开始批改", variant="stop")
                 next_btn = gr.Button("批改下一篇", variant="secondary")
 
+                # 批量模式：逐篇上传后加入队列，再统一并发批改
+                batch_queue = gr.State([])
+                with gr.Row():
+                    enqueue_btn = gr.Button("加入批量队列", variant="secondary")
+                    batch_btn = gr.Button("批量批改", variant="primary")
+                batch_status = gr.Markdown("**批量队列**: 0 篇")
+
             with gr.Column(scale=6, elem_classes="result-area"):
                 process_status = gr.Markdown("**当前状态**: 等待上传图片")
                 
@@ -315,7 +600,7 @@ def create_interface():
         def update_gallery(files):
             return files, files  # 返回更新后的Gallery和State
 
-        def full_process(files, history):
+        async def full_process(files, history):
             try:
                 validate_image_files(files)
                 
@@ -325,56 +610,97 @@ def create_interface():
                     image_gallery: files  # 确保在outputs中包含image_gallery
                 }
 
+                # 相同图片已批改过时直接复用缓存结果
+                cache_key, cached = await lookup_cached(files)
+
                 # 流式提取文本
-                text_gen = stream_extract_text(files)
-                full_text = ""
-                for partial_text in text_gen:
-                    full_text = partial_text
-                    yield {
-                        process_status: "**当前状态**: 正在提取文本...",
-                        extracted_text: full_text
-                    }
-
-                # 分割标题和内容
-                lines = full_text.split("\n", 1)
-                title = lines[0].strip() or "未命名作文"
-                content = lines[1].strip() if len(lines) > 1 else ""
+                text_gen = replay_text(cached[0]) if cached is not None else stream_extract_text(files)
+                text_parts: list[str] = []
+                last_emit = 0.0
+                async for delta_text in text_gen:
+                    text_parts.append(delta_text)
+                    # 限制界面刷新频率，结束后再输出完整内容
+                    now = time.monotonic()
+                    if now - last_emit >= config.UI_TEXT_INTERVAL:
+                        last_emit = now
+                        yield {
+                            process_status: "**当前状态**: 正在提取文本...",
+                            extracted_text: "".join(text_parts)
+                        }
+
+                full_text = "".join(text_parts)
+                yield {extracted_text: full_text}
 
                 # 流式生成批改
-                rate_gen = stream_rate_text(content)
-                full_rate = ""
-                for partial_rate in rate_gen:
-                    full_rate = partial_rate
-                    yield {
-                        process_status: "**当前状态**: 正在生成批改...",
-                        rating_result: f"## 批改结果\n{full_rate}"
-                    }
-
-                # 保存结果
-                text_path = safe_save(content, TEXTS_DIR, title)
-                rate_path = safe_save(full_rate, RATES_DIR, f"{title}_批改")
-
-                # 更新历史记录
-                new_entry = {
-                    "title": title,
-                    "timestamp": datetime.datetime.now().strftime("%Y-%m-%d %H:%M"),
-                    "text_path": text_path,
-                    "rate_path": rate_path
-                }
+                if cached is not None:
+                    rate_gen = replay_text(cached[1])
+                else:
+                    rate_gen = stream_rate_text(split_essay(full_text)[1])
+                rate_parts: list[str] = []
+                last_emit = 0.0
+                async for delta_rate in rate_gen:
+                    rate_parts.append(delta_rate)
+                    now = time.monotonic()
+                    if now - last_emit >= config.UI_RATE_INTERVAL:
+                        last_emit = now
+                        yield {
+                            process_status: "**当前状态**: 正在生成批改...",
+                            rating_result: f"## 批改结果\n{''.join(rate_parts)}"
+                        }
+
+                full_rate = "".join(rate_parts)
+                yield {rating_result: f"## 批改结果\n{full_rate}"}
+
+                # 保存结果并更新历史记录
+                new_entry = await finish_essay(cache_key, cached, full_text, full_rate)
                 updated_history = history + [new_entry]
-                save_history(updated_history)
 
                 yield {
                     process_status: "**当前状态**: 批改完成！",
-                    download_text: text_path,
-                    download_rate: rate_path,
-                    history_table: pd.DataFrame(updated_history),
+                    download_text: new_entry["text_path"],
+                    download_rate: new_entry["rate_path"],
+                    history_table: history_rows(updated_history),
                     history_state: updated_history
                 }
 
             except Exception as e:
                 yield {process_status: f"**错误**: {str(e)}"}
 
+        def enqueue_essay(files, queue):
+            if not files:
+                return queue, "**批量队列**: 请先上传作文图片", files, files
+            updated_queue = queue + [list(files)]
+            # 清空当前上传，便于继续上传下一篇
+            return updated_queue, f"**批量队列**: {len(updated_queue)} 篇", None, []
+
+        async def batch_process(queue, history):
+            if not queue:
+                yield {batch_status: "**批量队列**: 队列为空"}
+                return
+
+            total = len(queue)
+            results = [f"{i + 1}. 等待批改" for i in range(total)]
+            new_entries = []
+            yield {batch_status: f"**批量批改**: 0/{total}\n\n" + "\n".join(results)}
+
+            done = 0
+            async for index, entry, error in grade_batch(queue):
+                done += 1
+                if error is None:
+                    new_entries.append(entry)
+                    results[index] = f"{index + 1}. ✅ {entry['title']}"
+                else:
+                    results[index] = f"{index + 1}. ❌ {error}"
+                yield {batch_status: f"**批量批改**: {done}/{total}\n\n" + "\n".join(results)}
+
+            updated_history = history + new_entries
+            yield {
+                batch_status: f"**批量批改完成**: 成功 {len(new_entries)}/{total}\n\n" + "\n".join(results),
+                batch_queue: [],
+                history_table: history_rows(updated_history),
+                history_state: updated_history
+            }
+
         def reset_ui():
             return [
                 None,  # image_gallery
@@ -405,7 +731,22 @@ def create_interface():
                 download_rate,     # 输出6
                 history_table,     # 输出7
                 history_state      # 输出8
-            ]
+            ],
+            concurrency_limit=config.EVENT_CONCURRENCY
+        )
+
+        enqueue_btn.click(
+            fn=enqueue_essay,
+            inputs=[uploaded_files, batch_queue],
+            outputs=[batch_queue, batch_status, image_gallery, uploaded_files],
+            queue=False
+        )
+
+        batch_btn.click(
+            fn=batch_process,
+            inputs=[batch_queue, history_state],
+            outputs=[batch_status, batch_queue, history_table, history_state],
+            concurrency_limit=config.EVENT_CONCURRENCY
         )
 
         next_btn.click(
@@ -421,10 +762,14 @@ def create_interface():
             queue=False
         )
 
+        # 在Gradio的事件循环中预热API连接，连接池随后可直接复用
+        demo.load(fn=warmup_client, queue=False)
+
     return demo
 
 # --- 启动应用 ---
 if __name__ == "__main__":
+    _migrate_legacy_history()
     app = create_interface()
     app.launch(
         server_name="127.0.0.1",